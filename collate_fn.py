@@ -1,27 +1,22 @@
 import torch
 
 
-def collate_fn(batch, sep_token_id=2):
+def collate_fn(batch, sep_token_id=2, pad_to_multiple_of=None):
     # batch가 1 sample씩 들어있음
-    max_len=0
-    SEP_TOKEN = sep_token_id
-    new_batch={'input_ids':[],'attention_mask':[],'token_type_ids':[],'labels':[]}
+    # tokenized_dataset에서 이미 같은 길이로 padding 되어 있으므로 stack 한 번으로 tensor 변환
+    new_batch = {key: torch.stack([element[key] for element in batch]) for key in batch[0]}
 
-    # max_len 구하기
-    for element in batch:
-        input_id = element['input_ids']
-        cur_len = int((input_id==SEP_TOKEN).nonzero(as_tuple=True)[0][-1])
-        max_len = max(max_len, cur_len)
+    # max_len 구하기 : batch 내 어느 문장에든 SEP token이 있는 마지막 위치
+    is_sep = (new_batch['input_ids'] == sep_token_id).any(dim=0)
+    max_len = int(is_sep.nonzero(as_tuple=True)[0][-1])
 
-    for element in batch:
-        for key,value in element.items():
-            if key!='labels':
-                new_batch[key].append(value[:max_len+1].numpy().tolist())
-            else:
-                new_batch[key].append(value.numpy().tolist())
+    seq_len = max_len + 1
+    if pad_to_multiple_of:
+        # 길이를 pad_to_multiple_of의 배수로 맞춰 batch shape 종류를 줄임 (jit graph 재사용)
+        seq_len = min(-(-seq_len // pad_to_multiple_of) * pad_to_multiple_of, new_batch['input_ids'].size(1))
 
-    # 파이썬 리스트 -> 텐서 변환
-    for key,value in new_batch.items():
-        new_batch[key]=torch.tensor(new_batch[key])
+    for key, value in new_batch.items():
+        if key != 'labels':
+            new_batch[key] = value[:, :seq_len].contiguous()
 
-    return new_batch
\ No newline at end of file
+    return new_batch
@@ -63,15 +63,6 @@ def compute_metrics(pred):
         'accuracy': acc,
     }
 
-def label_to_num(label):
-    num_label = []
-    with open('dict_label_to_num.pkl', 'rb') as f:
-        dict_label_to_num = pickle.load(f)
-    for v in label:
-        num_label.append(dict_label_to_num[v])
-    
-    return num_label
-
 def seed_everything(seed=42):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
@@ -1,56 +1,255 @@
 import json
 from gevent import config
 from transformers import AutoTokenizer, AutoConfig, AutoModelForSequenceClassification, Trainer, TrainingArguments
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from load_data import *
 import pandas as pd
 import torch
 import torch.nn.functional as F
 
-from functools import partial
+from functools import partial, lru_cache
 from collate_fn import collate_fn
 import pickle as pickle
 import numpy as np
 import argparse
+import shutil
 from tqdm import tqdm
 
-from train import label_to_num
 
-def inference(model, tokenizer, tokenized_sent, device):
+def length_sorted_indices(re_dataset):
+    """
+    padding을 제외한 token 길이 순으로 정렬된 index를 반환 합니다.
+    비슷한 길이의 문장끼리 batch를 만들면 collate_fn의 padding이 줄어듭니다.
+    """
+    return torch.argsort(re_dataset.pair_dataset['attention_mask'].sum(dim=-1))
+
+def inference(model, tokenizer, tokenized_sent, device, probs_buf=None, pad_to_multiple_of=None, num_workers=0):
     """
     test dataset을 DataLoader로 만들어 준 후,
     batch_size로 나눠 model이 예측 합니다.
+    batch별 logits은 device 위의 probs_buf에 바로 더해지므로
+    여러 model의 logits을 같은 buffer에 누적할 수 있습니다.
+    batch는 길이 순으로 만들지만 probs_buf는 원래 순서를 유지합니다.
     """
-    dataloader = DataLoader(tokenized_sent, batch_size=32, shuffle=False, collate_fn=partial(collate_fn, sep_token_id=tokenizer.sep_token_id))
+    sort_idx = length_sorted_indices(tokenized_sent)
+    dataloader = DataLoader(Subset(tokenized_sent, sort_idx.tolist()), batch_size=32, shuffle=False, collate_fn=partial(collate_fn, sep_token_id=tokenizer.sep_token_id, pad_to_multiple_of=pad_to_multiple_of), pin_memory=device.type == 'cuda', num_workers=num_workers)
     model.eval()
-    output_pred = []
-    output_prob = []
+    sort_idx = sort_idx.to(device)
+    offset = 0
     for i, data in enumerate(tqdm(dataloader)):
-        with torch.no_grad():
+        data = to_device(data, device)
+        with torch.inference_mode():
+            # traced model도 호출할 수 있도록 positional argument로 전달
             outputs = model(
-                    input_ids=data['input_ids'].to(device),
-                    attention_mask=data['attention_mask'].to(device),
-                    token_type_ids=data['token_type_ids'].to(device)
+                    data['input_ids'],
+                    data['attention_mask'],
+                    data['token_type_ids']
                     )
-        logits = outputs[0]
-        prob = F.softmax(logits, dim=-1).detach().cpu().numpy()
-        logits = logits.detach().cpu().numpy()
-        result = np.argmax(logits, axis=-1)
+        logits = outputs['logits']
+        if probs_buf is None:
+            probs_buf = torch.zeros([len(tokenized_sent), logits.size(-1)], device=device)
+        probs_buf.index_add_(0, sort_idx[offset:offset + logits.size(0)], logits.detach().float())
+        offset += logits.size(0)
+
+    # softmax, argmax는 device에서 계산하고 결과만 한 번씩 CPU로 복사
+    prob = F.softmax(probs_buf, dim=-1)
+    result = prob.argmax(dim=-1).cpu().numpy()
+    prob = prob.cpu().numpy()
+
+    return result, prob.tolist()
+
+def jit_model(model, tokenizer, re_dataset, device, jit, pad_to_multiple_of):
+    """
+    model을 TorchScript로 trace('trace') 하거나 torch.compile('compile') 합니다.
+    batch 길이는 pad_to_multiple_of의 배수로 맞춰지므로 graph를 다시 만드는 shape 수가 제한됩니다.
+    """
+    model.eval()
+    if jit == 'trace':
+        example = collate_fn([re_dataset[i] for i in range(2)], sep_token_id=tokenizer.sep_token_id, pad_to_multiple_of=pad_to_multiple_of)
+        example_input = tuple(example[key].to(device) for key in ['input_ids', 'attention_mask', 'token_type_ids'])
+        with torch.no_grad():
+            model = torch.jit.trace(model, example_input, strict=False)
+    elif jit == 'compile':
+        model = torch.compile(model, dynamic=False)
+    return model
+
+class CUDAGraphRunner:
+    """
+    (batch_size, seq_len) shape별로 model forward를 CUDA Graph로 capture 해 두고 replay 합니다.
+    kernel launch overhead가 큰 작은 batch에서 효과가 있으며,
+    capture된 graph들은 하나의 memory pool을 공유합니다.
+    """
+    def __init__(self, model, device, warmup=3):
+        self.model = model
+        self.device = device
+        self.warmup = warmup
+        self.pool = torch.cuda.graph_pool_handle()
+        self.graphs = {}
+
+    def eval(self):
+        self.model.eval()
+        return self
+
+    def capture(self, shape):
+        static_inputs = [torch.zeros(shape, dtype=torch.long, device=self.device) for _ in range(3)]
+        static_inputs[1].fill_(1) # attention_mask
+
+        # capture 전에 side stream에서 warmup
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup):
+                self.model(*static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool):
+            static_output = self.model(*static_inputs)['logits']
+        return graph, static_inputs, static_output
+
+    def __call__(self, input_ids, attention_mask, token_type_ids):
+        shape = tuple(input_ids.shape)
+        if shape not in self.graphs:
+            self.graphs[shape] = self.capture(shape)
+        graph, static_inputs, static_output = self.graphs[shape]
+
+        for static_input, value in zip(static_inputs, (input_ids, attention_mask, token_type_ids)):
+            static_input.copy_(value, non_blocking=True)
+        graph.replay()
+        # static_output은 다음 replay에서 덮어써지므로 바로 사용해야 합니다.
+        return {'logits': static_output}
+
+def export_onnx(model, tokenizer, onnx_path, device):
+    """
+    batch, sequence 축이 dynamic인 ONNX 파일로 model을 export 합니다.
+    """
+    model.eval()
+    dummy = tokenizer("이순신[SEP]무신", "이순신은 조선 중기의 무신이다.", return_tensors="pt")
+    dummy_input = tuple(dummy[key].to(device) for key in ['input_ids', 'attention_mask', 'token_type_ids'])
+    dynamic_axes = {key: {0: 'batch', 1: 'sequence'} for key in ['input_ids', 'attention_mask', 'token_type_ids']}
+    dynamic_axes['logits'] = {0: 'batch'}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            dummy_input,
+            onnx_path,
+            input_names=['input_ids', 'attention_mask', 'token_type_ids'],
+            output_names=['logits'],
+            dynamic_axes=dynamic_axes,
+            opset_version=13,
+            )
+    print(f"{onnx_path}에 ONNX model 저장")
+
+def onnx_export_dir(model_dir):
+    """
+    checkpoint(pytorch_model.bin)의 수정 시각과 크기로 ONNX/TensorRT engine을 저장할 directory를 정합니다.
+    train.py가 같은 model_dir에 새 checkpoint를 덮어쓰면 directory 이름이 바뀌어 예전 export를 쓰지 않습니다.
+    """
+    stat = os.stat(os.path.join(model_dir, "pytorch_model.bin"))
+    return os.path.join(model_dir, f"onnx-{stat.st_mtime_ns}-{stat.st_size}")
+
+def clear_onnx_exports(model_dir):
+    """
+    model_dir 안의 예전 checkpoint로 만든 ONNX/INT8 ONNX model과 TensorRT engine cache를 지웁니다.
+    """
+    for name in os.listdir(model_dir):
+        if name.startswith("onnx-"):
+            shutil.rmtree(os.path.join(model_dir, name))
+    # onnx-* directory를 쓰기 전에 model_dir에 바로 저장하던 파일
+    for name in os.listdir(model_dir):
+        if name in ("model.onnx", "model.int8.onnx") or name.endswith((".engine", ".profile")):
+            os.remove(os.path.join(model_dir, name))
+
+def has_vnni():
+    """
+    CPU가 VNNI(INT8 dot product) 명령어를 지원하는지 확인 합니다.
+    """
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            cpu_flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_vnni' in cpu_flags or 'avx_vnni' in cpu_flags
+
+def quantize_onnx(onnx_path, quantized_path):
+    """
+    ONNX model의 weight를 per-channel INT8로 dynamic quantization 합니다.
+    """
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    quantize_dynamic(onnx_path, quantized_path, per_channel=True, weight_type=QuantType.QInt8)
+    print(f"{quantized_path}에 INT8 ONNX model 저장")
+
+def load_onnx_session(onnx_path, cache_dir):
+    """
+    TensorRT(FP16) -> CUDA -> CPU 순서로 사용 가능한 provider로 onnxruntime session을 만듭니다.
+    TensorRT engine은 cache_dir에 저장되어 다음 실행부터는 다시 build하지 않습니다.
+    batch마다 길이가 다르므로 (batch 1~32, 길이 1~256) 범위의 optimization profile을 하나 주어
+    처음 보는 shape마다 engine을 다시 build하지 않도록 합니다. (trt_profile_* option은 onnxruntime 1.15 이상)
+    """
+    import onnxruntime as ort
+
+    def profile_shapes(batch, seq_len):
+        return ','.join(f"{name}:{batch}x{seq_len}" for name in ['input_ids', 'attention_mask', 'token_type_ids'])
+
+    providers = [
+        ('TensorrtExecutionProvider', {
+            'trt_fp16_enable': True,
+            'trt_engine_cache_enable': True,
+            'trt_engine_cache_path': cache_dir,
+            'trt_profile_min_shapes': profile_shapes(1, 1),
+            'trt_profile_opt_shapes': profile_shapes(32, 128),
+            'trt_profile_max_shapes': profile_shapes(32, 256),
+        }),
+        'CUDAExecutionProvider',
+        'CPUExecutionProvider',
+    ]
+    available = ort.get_available_providers()
+    providers = [p for p in providers if (p[0] if isinstance(p, tuple) else p) in available]
+    return ort.InferenceSession(onnx_path, providers=providers)
+
+def inference_onnx(session, tokenizer, tokenized_sent, num_workers=0):
+    """
+    inference와 같은 방법으로 batch를 만든 후,
+    onnxruntime session으로 예측 합니다.
+    """
+    sort_idx = length_sorted_indices(tokenized_sent).numpy()
+    dataloader = DataLoader(Subset(tokenized_sent, sort_idx.tolist()), batch_size=32, shuffle=False, collate_fn=partial(collate_fn, sep_token_id=tokenizer.sep_token_id), num_workers=num_workers)
+    output_pred = []
+    output_prob = []
+    for i, data in enumerate(tqdm(dataloader)):
+        logits = session.run(['logits'], {
+                    'input_ids': data['input_ids'].numpy(),
+                    'attention_mask': data['attention_mask'].numpy(),
+                    'token_type_ids': data['token_type_ids'].numpy(),
+                    })[0]
+        logits = torch.from_numpy(logits).float()
+        prob = F.softmax(logits, dim=-1).numpy()
+        result = np.argmax(prob, axis=-1)
 
         output_pred.append(result)
         output_prob.append(prob)
-    
-    return np.concatenate(output_pred).tolist(), np.concatenate(output_prob, axis=0).tolist()
 
-def num_to_label(label):
+    # 길이 순으로 정렬했던 예측값을 원래 순서로 되돌림
+    unsort_idx = np.argsort(sort_idx)
+    return np.concatenate(output_pred)[unsort_idx].tolist(), np.concatenate(output_prob, axis=0)[unsort_idx].tolist()
+
+@lru_cache(maxsize=1)
+def _load_num_to_label_lut():
     """
-    숫자로 되어 있던 class를 원본 문자열 라벨로 변환 합니다.
+    dict_num_to_label.pkl을 한 번만 읽어
+    class 번호를 index로 하는 lookup table을 만듭니다.
     """
-    origin_label = []
     with open('dict_num_to_label.pkl', 'rb') as f:
         dict_num_to_label = pickle.load(f)
-    for v in label:
-        origin_label.append(dict_num_to_label[v])
+    return np.array([dict_num_to_label[i] for i in range(len(dict_num_to_label))], dtype=object)
+
+def num_to_label(label):
+    """
+    숫자로 되어 있던 class를 원본 문자열 라벨로 변환 합니다.
+    """
+    num_to_label_lut = _load_num_to_label_lut()
+    origin_label = num_to_label_lut[np.asarray(label, dtype=np.int64)].tolist()
     
     return origin_label
 
@@ -74,6 +273,10 @@ def main(args):
     """
     if not os.path.exists("./prediction"):
         os.mkdir("./prediction")
+    # Ampere 이상 GPU에서 FP32 matmul을 TF32 tensor core로 계산, 길이별로 가장 빠른 kernel 선택
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     # load tokenizer
     Tokenizer_NAME = os.path.join(args.model_dir, "..")
@@ -84,9 +287,6 @@ def main(args):
 
     ## load my model
     MODEL_NAME = args.model_dir # model dir.
-    model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
-    model.parameters
-    model.to(device)
 
     #print(model)
 
@@ -105,7 +305,43 @@ def main(args):
     print("[dataset 예시]", tokenizer.decode(Re_test_dataset[data_idx]['input_ids']), sep='\n')
 
     ## predict answer
-    pred_answer, output_prob = inference(model, tokenizer, Re_test_dataset, device) # model에서 class 추론
+    if args.backend == 'onnx':
+        export_dir = onnx_export_dir(MODEL_NAME)
+        onnx_path = os.path.join(export_dir, "model.onnx")
+        if not os.path.exists(onnx_path):
+            # checkpoint가 바뀌었으면 예전 ONNX model과 TensorRT engine을 지우고 CPU에서 다시 export
+            clear_onnx_exports(MODEL_NAME)
+            os.makedirs(export_dir)
+            model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
+            export_onnx(model, tokenizer, onnx_path, torch.device('cpu'))
+            del model
+        # VNNI를 지원하는 CPU에서만 INT8 model 사용 (그 외에는 FP32가 더 빠르거나 비슷함)
+        if device.type == 'cpu' and has_vnni():
+            # INT8 model도 같은 checkpoint directory에 두어 export와 함께 무효화
+            quantized_path = os.path.join(export_dir, "model.int8.onnx")
+            if not os.path.exists(quantized_path):
+                quantize_onnx(onnx_path, quantized_path)
+            onnx_path = quantized_path
+        session = load_onnx_session(onnx_path, cache_dir=export_dir)
+        pred_answer, output_prob = inference_onnx(session, tokenizer, Re_test_dataset, num_workers=args.num_workers) # onnxruntime으로 class 추론
+    else:
+        # GPU에서는 weight를 처음부터 FP16으로 load 해서 encoder weight/activation을 FP16으로 계산
+        # (transformers 4.10의 low_cpu_mem_usage 경로는 torch_dtype을 무시하므로 사용하지 않음)
+        torch_dtype = torch.float16 if device.type == 'cuda' else torch.float32
+        model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME, torch_dtype=torch_dtype)
+        model_dtype = next(model.parameters()).dtype
+        if model_dtype != torch_dtype:
+            raise ValueError(f"{MODEL_NAME}을 {torch_dtype}로 load 했지만 model weight가 {model_dtype} 입니다.")
+        model.to(device)
+        use_cuda_graph = args.cuda_graph == "True" and device.type == 'cuda'
+        pad_to_multiple_of = 32 if args.jit or use_cuda_graph else None
+        if args.jit:
+            model = jit_model(model, tokenizer, Re_test_dataset, device, args.jit, pad_to_multiple_of)
+        if use_cuda_graph:
+            model = CUDAGraphRunner(model.eval(), device)
+        pred_answer, output_prob = inference(model, tokenizer, Re_test_dataset, device, pad_to_multiple_of=pad_to_multiple_of, num_workers=args.num_workers) # model에서 class 추론
+        del model
+        torch.cuda.empty_cache()
     pred_answer = num_to_label(pred_answer) # 숫자로 된 class를 원래 문자열 라벨로 변환.
     
     ## make csv file with predicted answer
@@ -123,6 +359,10 @@ if __name__ == '__main__':
     parser.add_argument('--model_dir', type=str, default="./results/best_loss")
     parser.add_argument('--submission_name', type=str, default="submission")
     parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=min(8, os.cpu_count()))
+    parser.add_argument('--backend', type=str, default="torch") # 'torch', 'onnx'
+    parser.add_argument('--jit', type=str, default=None) # 'trace', 'compile'
+    parser.add_argument('--cuda_graph', type=str, default="False")
 
     args = parser.parse_args()
     print(args)
@@ -3,6 +3,8 @@ import torch
 import re
 import pandas as pd
 import pickle as pickle
+import numpy as np
+from functools import lru_cache
 
 
 class RE_Dataset(torch.utils.data.Dataset):
@@ -244,3 +246,19 @@ def tokenized_dataset(dataset, tokenizer, sep_type='SEP'):
         )
     
     return tokenized_sentences
+
+@lru_cache(maxsize=1)
+def _load_dict_label_to_num():
+    """ dict_label_to_num.pkl은 process당 한 번만 읽습니다. """
+    with open('dict_label_to_num.pkl', 'rb') as f:
+        return pickle.load(f)
+
+def label_to_num(label):
+    dict_label_to_num = _load_dict_label_to_num()
+    num_label = np.fromiter((dict_label_to_num[v] for v in label), dtype=np.int64, count=len(label))
+    
+    return num_label
+
+def to_device(batch, device):
+    """ batch(dict of tensor)의 모든 tensor를 한 번에 device로 비동기 복사 """
+    return {key: value.to(device, non_blocking=True) for key, value in batch.items()}
@@ -0,0 +1,44 @@
+import random
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    길이가 비슷한 sample끼리 batch를 만드는 batch sampler 입니다.
+    shuffle=True이면 HuggingFace의 LengthGroupedSampler처럼 index를 섞고
+    megabatch(mega_batch_mult * batch_size개) 단위로 나눈 후 megabatch 안에서만 길이 순으로 정렬합니다.
+    정렬된 index를 batch_size 단위로 자르고 batch 순서를 섞기 때문에
+    epoch마다 batch 구성이 달라지면서도 collate_fn에서 batch 내 최대 길이로 자를 때 padding이 줄어듭니다.
+    shuffle=False이면 전체를 길이 순으로 정렬합니다.
+    """
+    def __init__(self, lengths, batch_size, drop_last=False, shuffle=True, mega_batch_mult=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.shuffle = shuffle
+        self.mega_batch_mult = mega_batch_mult
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.permutation(len(self.lengths))
+            megabatch_size = self.mega_batch_mult * self.batch_size
+            megabatches = [indices[i:i + megabatch_size] for i in range(0, len(indices), megabatch_size)]
+            # megabatch 크기가 batch_size의 배수이므로 batch가 megabatch 경계를 넘지 않음
+            order = np.concatenate([megabatch[np.argsort(self.lengths[megabatch], kind='stable')] for megabatch in megabatches])
+        else:
+            order = np.argsort(self.lengths, kind='stable')
+
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            random.shuffle(batches)
+
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
@@ -2,6 +2,7 @@ import json
 import os
 import torch
 import random
+import concurrent.futures
 import warnings
 import sklearn
 import numpy as np
@@ -15,6 +16,7 @@ from torch.utils.data import DataLoader
 from torch.optim import AdamW
 # from torch.optim.lr_scheduler import StepLR, ReduceLROnPlateau
 from collate_fn import collate_fn
+from sampler import LengthGroupedBatchSampler
 from loss import create_criterion
 from scheduler import create_lr_scheduler
 from transformers import AutoTokenizer, AutoConfig, AutoModelForSequenceClassification, TrainingArguments, Trainer
@@ -46,7 +48,10 @@ def klue_re_micro_f1(preds, labels):
 
 def klue_re_auprc(probs, labels):
     """KLUE-RE AUPRC (with no_relation)"""
-    labels = np.eye(30)[labels]
+    # np.eye(30)[labels] 대신 one-hot을 직접 할당
+    onehot = np.zeros((len(labels), 30), dtype=np.float32)
+    onehot[np.arange(len(labels)), labels] = 1.0
+    labels = onehot
 
     score = np.zeros((30,))
     for c in range(30):
@@ -62,12 +67,12 @@ def klue_re_auprc(probs, labels):
     return np.average(score) * 100.0
 
 
-def compute_metrics(pred, labels):
-    """ validation을 위한 metrics function """
+def compute_eval_metrics(pred, labels):
+    """ validation을 위한 metrics function (valid set 전체의 logits, labels를 모아서 한 번 호출) """
     # labels = pred.label_ids
     # preds = pred.predictions.argmax(-1)
     # probs = pred.predictions
-    pred = pred.detach().cpu().numpy()
+    pred = pred.detach().float().cpu().numpy()
     labels = labels.detach().cpu().numpy()
     preds = pred.argmax(-1)
     probs = pred
@@ -83,29 +88,53 @@ def compute_metrics(pred, labels):
         'accuracy': acc,
     }
 
-def label_to_num(label):
-    num_label = []
-    with open('dict_label_to_num.pkl', 'rb') as f:
-        dict_label_to_num = pickle.load(f)
-    for v in label:
-        num_label.append(dict_label_to_num[v])
-    
-    return num_label
+def compute_train_metrics(preds, labels):
+    """ train logging을 위한 metrics function (auprc 제외) """
+    preds = preds.detach().cpu().numpy()
+    labels = labels.detach().cpu().numpy()
+
+    f1 = klue_re_micro_f1(preds, labels)
+    acc = accuracy_score(labels, preds)
+
+    return {
+        'micro f1 score': f1,
+        'accuracy': acc,
+    }
+
+def save_pretrained_async(io_pool, model, save_dirs):
+    """
+    model weight를 CPU로 한 번 복사한 후,
+    save_dirs에 save_pretrained 하는 disk IO는 io_pool(background thread)에서 처리합니다.
+    """
+    # CPU model에서는 .cpu()가 같은 tensor를 반환하므로 copy=True로 항상 복사본을 만듦
+    state_dict = {key: value.detach().to('cpu', copy=True) for key, value in model.state_dict().items()}
+
+    def _save():
+        for save_dir in save_dirs:
+            model.save_pretrained(save_dir, state_dict=state_dict)
 
-def seed_everything(seed):
+    return io_pool.submit(_save)
+
+def seed_everything(seed, deterministic=False):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)  # if use multi-GPU
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    # deterministic이 아니면 cuDNN이 shape별로 가장 빠른 kernel을 고르도록 benchmark 사용
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
     np.random.seed(seed)
     random.seed(seed)
 
+def seed_worker(worker_id, seed):
+    """ DataLoader worker process별로 numpy, random seed 고정 """
+    np.random.seed(seed + worker_id)
+    random.seed(seed + worker_id)
+
 def train(args):
     # get random number to choose example sentence
     data_idx = random.randint(0, 32)
     # hold seeds
-    seed_everything(args.seed)
+    seed_everything(args.seed, deterministic=args.deterministic == "True")
     # load model and tokenizer
     MODEL_NAME = args.model
     tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
@@ -120,14 +149,18 @@ def train(args):
     # load dataset
     dataset = load_data("../dataset/train/train.csv", token_type=args.token_type)
 
-    train_dataset, valid_dataset = train_test_split(dataset, test_size=args.val_ratio, shuffle=True, stratify=dataset['label'], random_state=args.seed)
+    dataset_label = label_to_num(dataset['label'].values)
+
+    # tokenizing dataset : 전체 dataset을 한 번만 tokenizing 한 후 split index로 나눔
+    tokenized_all = tokenized_dataset(dataset, tokenizer,sep_type=args.sep_type)
 
-    train_label = label_to_num(train_dataset['label'].values)
-    valid_label = label_to_num(valid_dataset['label'].values)
+    train_idx, valid_idx = train_test_split(np.arange(len(dataset)), test_size=args.val_ratio, shuffle=True, stratify=dataset['label'], random_state=args.seed)
 
-    # tokenizing dataset
-    tokenized_train = tokenized_dataset(train_dataset, tokenizer,sep_type=args.sep_type)
-    tokenized_valid = tokenized_dataset(valid_dataset, tokenizer,sep_type=args.sep_type)
+    train_label = dataset_label[train_idx]
+    valid_label = dataset_label[valid_idx]
+
+    tokenized_train = {key: val[torch.as_tensor(train_idx)] for key, val in tokenized_all.items()}
+    tokenized_valid = {key: val[torch.as_tensor(valid_idx)] for key, val in tokenized_all.items()}
 
     # make dataset for pytorch.
     RE_train_dataset = RE_Dataset(tokenized_train, train_label)
@@ -142,20 +175,37 @@ def train(args):
     model_config.num_labels = 30
     model_config.hidden_dropout_prob = args.dropout
     model_config.attention_probs_dropout_prob = args.dropout
+    if args.grad_ckpt == "True":
+        # backward에서 activation을 다시 계산해 activation memory 절약 (transformers 4.10은 config로 설정)
+        model_config.gradient_checkpointing = True
+        model_config.use_cache = False
 
     model = AutoModelForSequenceClassification.from_pretrained(MODEL_NAME, config=model_config)
     model.resize_token_embeddings(num_added_token + tokenizer.vocab_size)
     print(model.config)
     model.to(device)
+    # forward는 compile된 model로, 저장/optimizer는 원래 model로 (같은 parameter를 공유)
+    forward_model = torch.compile(model, dynamic=True) if args.compile == "True" else model
     
-    train_loader = DataLoader(RE_train_dataset, batch_size=args.batch_size, shuffle=True, drop_last = True, collate_fn=partial(collate_fn, sep_token_id=tokenizer.sep_token_id))
-    valid_loader = DataLoader(RE_valid_dataset, batch_size=args.valid_batch_size, shuffle=True, drop_last = False, collate_fn=partial(collate_fn, sep_token_id=tokenizer.sep_token_id))
+    if args.group_by_length == "True":
+        # 길이가 비슷한 문장끼리 batch를 만들어 padding 낭비를 줄임
+        train_lengths = tokenized_train['attention_mask'].sum(dim=-1).numpy()
+        train_batch_kwargs = {'batch_sampler': LengthGroupedBatchSampler(train_lengths, args.batch_size, drop_last=True)}
+    else:
+        train_batch_kwargs = {'batch_size': args.batch_size, 'shuffle': True, 'drop_last': True}
+    train_loader = DataLoader(RE_train_dataset, **train_batch_kwargs, collate_fn=partial(collate_fn, sep_token_id=tokenizer.sep_token_id), pin_memory=device.type == 'cuda', num_workers=args.num_workers, persistent_workers=args.num_workers > 0, worker_init_fn=partial(seed_worker, seed=args.seed))
+    valid_loader = DataLoader(RE_valid_dataset, batch_size=args.valid_batch_size, shuffle=True, drop_last = False, collate_fn=partial(collate_fn, sep_token_id=tokenizer.sep_token_id), pin_memory=device.type == 'cuda', num_workers=args.num_workers, persistent_workers=args.num_workers > 0, worker_init_fn=partial(seed_worker, seed=args.seed))
     print("[첫째 batch]\n", tokenizer.decode(next(iter(train_loader))["input_ids"][data_idx]))
     # print(next(iter(train_loader))["input_ids"])
 
     optim = AdamW(model.parameters(), lr=args.lr)
     criterion = create_criterion(args.criterion)
 
+    # mixed precision (fp16은 GradScaler로 loss scaling, bf16은 scaling 불필요)
+    use_amp = args.precision in ('fp16', 'bf16') and device.type == 'cuda'
+    amp_dtype = torch.bfloat16 if args.precision == 'bf16' else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp and args.precision == 'fp16')
+
     if args.lr_scheduler:
         scheduler = create_lr_scheduler(args.lr_scheduler, optimizer=optim, mode='min', patience=1, factor=0.5, verbose=True)
 
@@ -190,93 +240,116 @@ def train(args):
 
     best_eval_loss = 1e9
     best_eval_f1 = 0
+    # checkpoint 저장은 thread 하나에서 순서대로 처리되므로 학습과 겹쳐서 진행됨
+    io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    save_future = None
     total_idx = 0
 
     schedule_idx = 1
     for epoch in range(args.epochs):
-        total_f1, total_loss, total_acc = 0, 0, 0
+        total_loss = 0
         average_loss, average_f1, average_acc = 0,0,0
+        # metric은 step마다 계산하지 않고 예측값을 device에 모아 두었다가 logging 할 때만 계산
+        train_pred_list, train_label_list = [], []
 
         # LR scheduler
         if epoch > 1 and epoch % 2 == 0:
             schedule_idx *= 2
             optim = AdamW(model.parameters(), lr=args.lr / 2)
+        optim.zero_grad(set_to_none=True)
         
-        for idx, batch in enumerate(tqdm(train_loader)):
+        # 진행 표시줄 갱신 횟수를 줄이고, log는 tqdm.write로 출력
+        for idx, batch in enumerate(tqdm(train_loader, mininterval=1.0, miniters=args.logging_step)):
             model.train()
-            total_idx += 1
-
-            optim.zero_grad()
-            input_ids = batch['input_ids'].to(device)
-            attention_mask = batch['attention_mask'].to(device)
-            token_type_ids =  batch['token_type_ids'].to(device)
-            labels = batch['labels'].to(device)
-            outputs = model(input_ids, attention_mask=attention_mask, labels=labels,token_type_ids=token_type_ids)
-            pred = outputs[1]
-            metric = compute_metrics(pred, labels)
-
-            # loss = outputs[0]
-            loss = criterion(pred, labels)
-
-            loss.backward()
-            optim.step()
-            total_loss += loss
-            total_f1 += metric['micro f1 score']
-            # total_auprc += metric['auprc']
-            total_acc += metric['accuracy']
-
-            average_loss = total_loss/(idx+1)
-            average_f1 = total_f1/(idx+1)
-            average_acc = total_acc/(idx+1)
 
+            batch = to_device(batch, device)
+            input_ids = batch['input_ids']
+            attention_mask = batch['attention_mask']
+            token_type_ids =  batch['token_type_ids']
+            labels = batch['labels']
+            with torch.cuda.amp.autocast(enabled=use_amp, dtype=amp_dtype):
+                # labels를 넘기지 않아 model 내부의 loss 계산을 건너뜀 (loss는 criterion으로 계산)
+                outputs = forward_model(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+                pred = outputs.logits
+
+                # loss = outputs[0]
+                loss = criterion(pred, labels)
+
+            # grad_accum_steps개의 batch gradient를 모은 후 optimizer step (epoch 마지막 batch에서는 남은 gradient로 step)
+            scaler.scale(loss / args.grad_accum_steps).backward()
+            is_update_step = (idx + 1) % args.grad_accum_steps == 0 or idx + 1 == len(train_loader)
+            if is_update_step:
+                scaler.step(optim)
+                scaler.update()
+                optim.zero_grad(set_to_none=True)
+                total_idx += 1
+            total_loss += loss.detach()
+            train_pred_list.append(pred.detach().argmax(-1))
+            train_label_list.append(labels)
+
+            # loss를 CPU로 가져오는 sync는 logging 할 때만
             if idx%args.logging_step == 0:
-                print(f"[TRAIN][EPOCH:({epoch + 1}/{args.epochs}) | loss:{average_loss:4.2f} | ", end="")
-                print(f"micro_f1_score:{average_f1:4.2f} | accuracy:{average_acc:4.2f}]")
+                average_loss = (total_loss/(idx+1)).item()
+                metric = compute_train_metrics(torch.cat(train_pred_list), torch.cat(train_label_list))
+                average_f1 = metric['micro f1 score']
+                average_acc = metric['accuracy']
+                tqdm.write(f"[TRAIN][EPOCH:({epoch + 1}/{args.epochs}) | loss:{average_loss:4.2f} | "
+                           f"micro_f1_score:{average_f1:4.2f} | accuracy:{average_acc:4.2f}]")
 
         
-            if total_idx%args.eval_step == 0:
-                eval_total_loss, eval_total_f1, eval_total_auprc, eval_total_acc = 0, 0, 0, 0
+            if is_update_step and total_idx%args.eval_step == 0:
+                eval_total_loss = 0
+                eval_pred_list, eval_label_list = [], []
                 with torch.no_grad():
                     model.eval()
-                    print("--------------------------------------------------------------------------")
-                    print(f"[EVAL] STEP:{total_idx}, BATCH SIZE:{args.batch_size}")
+                    tqdm.write("--------------------------------------------------------------------------")
+                    tqdm.write(f"[EVAL] STEP:{total_idx}, BATCH SIZE:{args.batch_size}")
                     for idx, batch in enumerate(tqdm(valid_loader)):
 
-                        input_ids = batch['input_ids'].to(device)
-                        attention_mask = batch['attention_mask'].to(device)
-                        token_type_ids =  batch['token_type_ids'].to(device)
-                        labels = batch['labels'].to(device)
-                        outputs = model(input_ids, attention_mask=attention_mask, labels=labels, token_type_ids=token_type_ids)
-                        pred = outputs[1]
-                        eval_metric = compute_metrics(pred, labels)
-
-                        # loss = outputs[0]
-                        loss = criterion(pred, labels)
-
-                        eval_total_loss += loss
-                        eval_total_f1 += eval_metric['micro f1 score']
-                        eval_total_auprc += eval_metric['auprc']
-                        eval_total_acc += eval_metric['accuracy']
-
-                    eval_average_loss = eval_total_loss/len(valid_loader)
-                    eval_average_f1 = eval_total_f1/len(valid_loader)
-                    eval_total_auprc = eval_total_auprc/len(valid_loader)
-                    eval_average_acc = eval_total_acc/len(valid_loader)
+                        batch = to_device(batch, device)
+                        input_ids = batch['input_ids']
+                        attention_mask = batch['attention_mask']
+                        token_type_ids =  batch['token_type_ids']
+                        labels = batch['labels']
+                        with torch.cuda.amp.autocast(enabled=use_amp, dtype=amp_dtype):
+                            outputs = forward_model(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids)
+                            pred = outputs.logits
+
+                            # loss = outputs[0]
+                            loss = criterion(pred, labels)
+
+                        eval_total_loss += loss.detach()
+                        eval_pred_list.append(pred)
+                        eval_label_list.append(labels)
+
+                    # valid set 전체에 대해 한 번만 metric 계산
+                    eval_metric = compute_eval_metrics(torch.cat(eval_pred_list), torch.cat(eval_label_list))
+                    eval_average_loss = (eval_total_loss/len(valid_loader)).item()
+                    eval_average_f1 = eval_metric['micro f1 score']
+                    eval_total_auprc = eval_metric['auprc']
+                    eval_average_acc = eval_metric['accuracy']
 
                     if args.lr_scheduler:
                         scheduler.step(eval_average_loss)
 
+                    save_dirs = []
                     if args.checkpoint:
-                        model.save_pretrained(os.path.join(save_path, f"checkpoint-{total_idx}"))
+                        save_dirs.append(os.path.join(save_path, f"checkpoint-{total_idx}"))
 
                     if eval_average_loss < best_eval_loss:
-                        model.save_pretrained(os.path.join(save_path, "best_loss"))
+                        save_dirs.append(os.path.join(save_path, "best_loss"))
                         best_eval_loss = eval_average_loss
 
                     if eval_average_f1 > best_eval_f1:
-                        model.save_pretrained(os.path.join(save_path, "best_f1"))
+                        save_dirs.append(os.path.join(save_path, "best_f1"))
                         best_eval_f1 = eval_average_f1
 
+                    if save_dirs:
+                        # 이전 저장이 끝나야 다음 snapshot을 만듦 (CPU 복사본은 최대 하나, 저장 에러는 바로 raise)
+                        if save_future is not None:
+                            save_future.result()
+                        save_future = save_pretrained_async(io_pool, model, save_dirs)
+
                     if args.wandb == "True":
                         wandb.log({
                             "step":total_idx,
@@ -286,10 +359,15 @@ def train(args):
                             "learning_rate": optim.param_groups[0]['lr']
                             })
 
-                    print(f"[EVAL][loss:{eval_average_loss:4.2f} | auprc:{eval_total_auprc:4.2f} | ", end="")
-                    print(f"micro_f1_score:{eval_average_f1:4.2f} | accuracy:{eval_average_acc:4.2f}]")
+                    tqdm.write(f"[EVAL][loss:{eval_average_loss:4.2f} | auprc:{eval_total_auprc:4.2f} | "
+                               f"micro_f1_score:{eval_average_f1:4.2f} | accuracy:{eval_average_acc:4.2f}]")
 
-                print("--------------------------------------------------------------------------")
+                tqdm.write("--------------------------------------------------------------------------")
+
+        average_loss = (total_loss/len(train_loader)).item()
+        metric = compute_train_metrics(torch.cat(train_pred_list), torch.cat(train_label_list))
+        average_f1 = metric['micro f1 score']
+        average_acc = metric['accuracy']
 
         if args.wandb == "True":
             wandb.log({
@@ -306,11 +384,19 @@ def train(args):
             #     scheduler.step()
 
     
+    # 남은 checkpoint 저장이 끝날 때까지 대기 (저장 중 에러가 있었다면 여기서 raise)
+    io_pool.shutdown(wait=True)
+    if save_future is not None:
+        save_future.result()
+
     if args.wandb == "True":
         wandb.finish()
 
 
 def main(args):
+    # Ampere 이상 GPU에서 FP32 matmul을 TF32 tensor core로 계산
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     train(args)
 
 if __name__ == '__main__':
@@ -337,6 +423,13 @@ if __name__ == '__main__':
     parser.add_argument('--dropout', type=float, default=0.1)
     parser.add_argument('--sep_type', type=str, default='SEP') # SEP, ENT
     parser.add_argument('--lr_scheduler', type=str) # 'stepLR', 'reduceLR', 'cosine_anneal_warm', 'cosine_anneal', 'custom_cosine'
+    parser.add_argument('--precision', type=str, default="fp16") # 'fp32', 'fp16', 'bf16'
+    parser.add_argument('--num_workers', type=int, default=min(8, os.cpu_count()))
+    parser.add_argument('--group_by_length', type=str, default="True")
+    parser.add_argument('--deterministic', type=str, default="False")
+    parser.add_argument('--grad_accum_steps', type=int, default=1)
+    parser.add_argument('--grad_ckpt', type=str, default="False")
+    parser.add_argument('--compile', type=str, default="False")
     
     args = parser.parse_args()
     main(args)
\ No newline at end of file